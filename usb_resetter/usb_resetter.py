@@ -23,19 +23,15 @@ __url__ = "https://github.com/netinvent/usb_resetter"
 __compat__ = "python2.7+"
 
 
-from typing import List
-import fcntl
+from typing import List, Iterator
+from fcntl import ioctl
 import re
+import fnmatch
 import os
+import errno
 import sys
-import glob
-import argparse
 from collections import namedtuple
-
-
-if not "linux" in sys.platform:
-    print("This script can only run on Linux")
-    sys.exit(3)
+from concurrent.futures import ThreadPoolExecutor
 
 
 # linux/usbdevice_fs.h equivalents
@@ -46,11 +42,39 @@ USBDEVFS_RESET = ord("U") << 8 | 20
 USBDEVFS_DISCONNECT = ord("U") << 8 | 22
 USBDEVFS_CONNECT = ord("U") << 8 | 23
 
-# Glob style path to USB contollers including USB3
-USB_CONTROLLER_PATHS = "/sys/bus/pci/drivers/[uoex]hci_hcd/*:*"
+# Signal names accepted by send_signal_usb_device
+_SIGNALS = {
+    "reset": USBDEVFS_RESET,
+    "disconnect": USBDEVFS_DISCONNECT,
+    "connect": USBDEVFS_CONNECT,
+}
+
+# USB contollers including USB3 are found in /sys/bus/pci/drivers/[uoex]hci_hcd/*:*
+PCI_DRIVERS_PATH = "/sys/bus/pci/drivers"
+
+# Maximum number of devices / controllers we handle concurrently
+MAX_WORKERS = 8
+
+# see https://wiki.debian.org/HowToIdentifyADevice/USB
+KERNEL_USB_DEBUG_PATH = "/sys/kernel/debug/usb/devices"
+
+USB_DEVICE_NODES_PATH = "/dev/bus/usb"
 
+USB_DEVICES_PATH = "/sys/bus/usb/devices"
 
-def hub_binder(hub_path, action):
+# Large enough to get the whole file in one read, default io buffers would need multiple ones
+USB_DEBUG_READ_SIZE = 1 << 20
+
+# Built once at import time, namedtuple class creation is costly
+Device = namedtuple(
+    "Device", "vendor_id, product_id, device_path, manufacturer, product"
+)
+
+# Precompiled pattern matching USB host controller driver names
+_RE_HCD_DRIVER = re.compile(fnmatch.translate("[uoex]hci_hcd"))
+
+
+def hub_binder(hub_path, *actions):
     """
     bind or unbind a usb hub / controller
     path: full path to usb hub / controller
@@ -58,10 +82,10 @@ def hub_binder(hub_path, action):
     Unbinding / binding is equivalent to a cold restart, but real usb power cannot be cut
     The device will still get power, but will not be able to talk to the computer
 
-    action: bind|unbind
+    actions: bind|unbind, multiple actions are executed in given order
     """
-    current_hub = os.path.basename(hub_path)
-    basepath = os.path.dirname(hub_path)
+    # sysfs paths always use / as separator, rpartition is cheaper than basename / dirname
+    basepath, _, current_hub = hub_path.rpartition("/")
 
     pci_unbind_path = "/sys/bus/pci/drivers"
     usb_unbind_path = "/sys/bus/usb/drivers/usb"
@@ -72,9 +96,27 @@ def hub_binder(hub_path, action):
     else:
         unbind_path = usb_unbind_path
 
-    print("{} hub {}/{}".format(action, basepath, current_hub))
-    with open(os.path.join(unbind_path, action), "w") as file_handle:
-        file_handle.write(current_hub)
+    payload = current_hub.encode("utf-8")
+    for action in actions:
+        print("{} hub {}/{}".format(action, basepath, current_hub))
+        # Raw os.write avoids building a text io stack for a single short sysfs write
+        fd = os.open(unbind_path + "/" + action, os.O_WRONLY)
+        try:
+            os.write(fd, payload)
+        finally:
+            os.close(fd)
+
+
+def _read_sysfs(path):
+    # type: (str) -> bytes
+    """
+    Read a short sysfs attribute with raw os calls, skipping the text io layers open() would build
+    """
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        return os.read(fd, 16).strip()
+    finally:
+        os.close(fd)
 
 
 def get_usb_hubs(vendor_id=None, product_id=None):
@@ -84,47 +126,95 @@ def get_usb_hubs(vendor_id=None, product_id=None):
     """
 
     hubs = []
+    filtered = vendor_id or product_id
+    if filtered:
+        # sysfs values are read as raw bytes, so encode our filters once
+        vendor_id = (vendor_id or "").encode("utf-8")
+        product_id = (product_id or "").encode("utf-8")
 
-    for entry in glob.glob("/sys/bus/usb/devices/**/idVendor"):
-        hub_path = os.path.dirname(entry)
-        abs_hub_path = os.path.abspath(hub_path)
-        vendor_id_file = os.path.join(abs_hub_path, "idVendor")
-        product_id_file = os.path.join(abs_hub_path, "idProduct")
+    try:
+        entries = os.scandir(USB_DEVICES_PATH)
+    except OSError:
+        return hubs
+
+    # sysfs entries are already absolute paths, so no need to normalize them
+    for entry in entries:
+        hub_path = entry.path
 
         try:
-            with open(vendor_id_file, "r") as file_handle:
-                found_vendor_id = file_handle.read().strip()
-            with open(product_id_file, "r") as file_handle:
-                found_product_id = file_handle.read().strip()
-
-            if (
-                vendor_id == found_vendor_id
-                and product_id == found_product_id
-                or (not vendor_id and not product_id)
-            ):
-                hubs.append(hub_path)
+            found_vendor_id = _read_sysfs(hub_path + "/idVendor")
+            # Don't bother reading the product id of a device we already know we don't want
+            if filtered and vendor_id != found_vendor_id:
+                continue
+            found_product_id = _read_sysfs(hub_path + "/idProduct")
+            if filtered and product_id != found_product_id:
+                continue
+        except FileNotFoundError:
+            # Not a device but an interface (ex: 1-1:1.0), nothing to identify
+            continue
         except OSError:
             print(
                 "Cannot identify which vendor/product is plugged in hub {}".format(
                     hub_path
                 )
             )
+            continue
+        hubs.append(hub_path)
 
     return hubs
 
 
-def list_usb_hubs(vendor_id=None, product_id=None):
+def list_usb_hubs(vendor_id=None, product_id=None, hubs=None):
     """
     vendor_id and product_id are optional filters
+    hubs: optional result of an earlier get_usb_hubs call with the same filters
     """
-    for hub in get_usb_hubs(vendor_id, product_id):
+    if hubs is None:
+        hubs = get_usb_hubs(vendor_id, product_id)
+    for hub in hubs:
         print("Found hub {}".format(hub))
 
 
 def reset_usb_hubs(hubs):
     for hub in hubs:
-        hub_binder(hub, "unbind")
-        hub_binder(hub, "bind")
+        hub_binder(hub, "unbind", "bind")
+
+
+def get_usb_controllers():
+    # type: () -> List[str]
+    """
+    Get paths of USB controllers, equivalent to /sys/bus/pci/drivers/[uoex]hci_hcd/*:*
+    Uses os.scandir instead of glob which stats every matched path component
+    """
+    controllers = []
+    try:
+        for driver in os.scandir(PCI_DRIVERS_PATH):
+            if not _RE_HCD_DRIVER.match(driver.name):
+                continue
+            for entry in os.scandir(driver.path):
+                if ":" in entry.name:
+                    controllers.append(entry.path)
+    except OSError:
+        pass
+    return controllers
+
+
+def _reset_usb_controller(controller):
+    # type: (str) -> bool
+    """
+    Unbind / bind a single USB controller, reporting failures instead of raising
+    so concurrent resets of other controllers are not lost
+    """
+    try:
+        hub_binder(controller, "unbind", "bind")
+        return True
+    except OSError as exc:
+        print(
+            "Cannot reset USB controller {}: {}".format(
+                controller, _os_error_reason(exc)
+            )
+        )
+        return False
 
 
 def reset_usb_controllers():
@@ -141,102 +231,146 @@ def reset_usb_controllers():
       echo "${i##*/}" > "${i%/*}/bind"
     done
     """
-    reset_usb_hubs(glob.glob(USB_CONTROLLER_PATHS))
+    # Controllers are independent PCI devices, so we can reset them concurrently
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        results = list(executor.map(_reset_usb_controller, get_usb_controllers()))
+    failures = results.count(False)
+    if failures:
+        raise OSError("Failed to reset {} USB controller(s)".format(failures))
 
 
-def get_usb_devices_paths(vendor_id=None, product_id=None, list_only=False):
-    # type: (str, str, bool) -> List[str]
+def _read_kernel_usb_devices():
+    # type: () -> str
     """
-    Emulates lsusb by reading from /sys/kernel/debug/usb/devices
-    Does not require lsusb to be installed and should work on a fair share of recent kernels
+    Read the whole content of /sys/kernel/debug/usb/devices
     """
-
-    found_devices = []
-    device_paths = []
-    Device = namedtuple(
-        "Devices", "vendor_id, product_id, device_path, manufacturer, product"
-    )
-    kernel_usb_debug_path = "/sys/kernel/debug/usb/devices"  # see https://wiki.debian.org/HowToIdentifyADevice/USB
-
-    if not os.path.isfile(kernel_usb_debug_path):
+    if not os.path.isfile(KERNEL_USB_DEBUG_PATH):
         # We could fallback to lsusb here if available, but then we need command_runner to deal with different subprocess.communicate outputs
         raise OSError(
             "Kernel path {} not found. Please run this script as root".format(
-                kernel_usb_debug_path
+                KERNEL_USB_DEBUG_PATH
             )
         )
 
-    with open(kernel_usb_debug_path, "r", encoding="utf-8") as file_handle:
-        first_device = True
-        manufacturer = None
-        product = None
-        found_vendor_id = None
-        found_product_id = None
-        device_path = None
+    # Unbuffered binary handle, so every read() below is a single read syscall
+    # The file is only a few KB, so this is usually a single read plus the EOF one
+    chunks = []
+    with open(KERNEL_USB_DEBUG_PATH, "rb", buffering=0) as file_handle:
         while True:
-            line = file_handle.readline()
-            if not line:
+            chunk = file_handle.read(USB_DEBUG_READ_SIZE)
+            if not chunk:
                 break
-            match = re.match(r"T:\s+Bus=(\d+).*Dev#=\s+(\d+)", line, re.IGNORECASE)
-            if match:
-                if not first_device:
-                    # New device (begins with T:), let's reset previous values that belong to earlier found devices
-                    found_devices.append(
-                        Device(
-                            vendor_id=found_vendor_id,
-                            product_id=found_product_id,
-                            device_path=device_path,
-                            manufacturer=manufacturer,
-                            product=product,
-                        )
-                    )
-                else:
-                    first_device = False
-                    manufacturer = None
-                    product = None
-                    found_vendor_id = None
-                    found_product_id = None
-
-                # bus and dev are always 3 digit numbers, ex 001, 003, 004
-                bus = "{:03d}".format(int(match.group(1)))
-                dev = "{:03d}".format(int(match.group(2)))
-            match = re.match(r"S:\s+Manufacturer=(.*)", line, re.IGNORECASE)
-            if match:
-                manufacturer = match.group(1)
-            match = re.match(r"S:\s+Product=(.*)", line, re.IGNORECASE)
-            if match:
-                product = match.group(1)
-            match = re.match(
-                r"P:\s+Vendor=([0-9A-F]{4})\s+ProdID=([0-9A-F]{4})", line, re.IGNORECASE
-            )
-            if match:
-                found_vendor_id = match.group(1)
-                found_product_id = match.group(2)
-                device_path = os.path.join("/dev/bus/usb", bus, dev)
-                if vendor_id == found_vendor_id and product_id == found_product_id:
-                    if os.path.exists(device_path):
-                        device_paths.append(device_path)
-                    else:
-                        print(
-                            "Device path not existing for bus {} dev {}".format(
-                                bus, dev
-                            )
-                        )
-    # We need to add the final device if exists:
-    if bus and dev:
-        found_devices.append(
-            Device(
-                vendor_id=found_vendor_id,
-                product_id=found_product_id,
-                device_path=device_path,
-                manufacturer=manufacturer,
-                product=product,
-            )
+            chunks.append(chunk)
+    return b"".join(chunks).decode("utf-8")
+
+
+def _enumerate_usb():
+    # type: () -> Iterator[Device]
+    """
+    Yield a Device record per device found in /sys/kernel/debug/usb/devices
+    """
+    return _parse_usb_devices(_read_kernel_usb_devices())
+
+
+def _parse_usb_devices(content):
+    # type: (str) -> Iterator[Device]
+    """
+    Parse /sys/kernel/debug/usb/devices content and yield a Device record per found device
+    Every device block begins with a T: line, so the current record is flushed on each new T: line
+    Kept free of any I/O so it can be fed with any devices dump
+    """
+
+    # Per line tag dispatch turned out faster than a single multiline regex finditer() over the whole
+    # content, since unneeded lines are discarded on their tag and the others are split with str methods
+    current = None
+    for line in content.splitlines():
+        # Every line is keyed by a two char tag, only T:, S: and P: lines are of interest
+        tag = line[:2]
+        if tag == "T:":
+            # T:  Bus=01 Lev=01 Prnt=01 Port=03 Cnt=01 Dev#= 12 Spd=12   MxCh= 0
+            bus = line.partition("Bus=")[2].partition(" ")[0]
+            dev = line.partition("Dev#=")[2].lstrip().partition(" ")[0]
+            # Whatever happens, a T: line ends the previous device block
+            if current is not None:
+                yield Device(**current)
+            if not (bus.isdigit() and dev.isdigit()):
+                # Ignore the whole block of a device we cannot locate, so its S: / P: lines
+                # don't end up in the previous device record
+                current = None
+                continue
+            # bus and dev are always 3 digit numbers, ex 001, 003, 004
+            bus = bus.zfill(3)
+            dev = dev.zfill(3)
+            current = {
+                "vendor_id": None,
+                "product_id": None,
+                "device_path": USB_DEVICE_NODES_PATH + "/" + bus + "/" + dev,
+                "manufacturer": None,
+                "product": None,
+            }
+        elif current is None:
+            # Ignore anything before the first device or within an unparsable device block
+            continue
+        elif tag == "S:":
+            # S: lines are plain key=value strings, no need for a regex here
+            key, _, value = line[2:].strip().partition("=")
+            if key == "Manufacturer":
+                current["manufacturer"] = value
+            elif key == "Product":
+                current["product"] = value
+        elif tag == "P:":
+            # P: lines have a fixed "Vendor=XXXX ProdID=XXXX" layout, no need for a regex either
+            _, found, vendor_part = line.partition("Vendor=")
+            if not found:
+                continue
+            current["vendor_id"] = vendor_part[:4]
+            current["product_id"] = vendor_part.partition("ProdID=")[2][:4]
+    # We need to add the final device if exists
+    if current is not None:
+        yield Device(**current)
+
+
+def _get_existing_usb_device_nodes():
+    # type: () -> frozenset
+    """
+    List /dev/bus/usb/[bus_number]/[device_number] nodes in one pass
+    so we don't need to stat every device path
+    """
+    try:
+        return frozenset(
+            entry.path
+            for bus in os.scandir(USB_DEVICE_NODES_PATH)
+            for entry in os.scandir(bus.path)
         )
+    except OSError:
+        return frozenset()
+
+
+def get_usb_devices_paths(vendor_id=None, product_id=None, list_only=False):
+    # type: (str, str, bool) -> List[str]
+    """
+    Emulates lsusb by reading from /sys/kernel/debug/usb/devices
+    Does not require lsusb to be installed and should work on a fair share of recent kernels
+    """
+
+    device_paths = []
+    # Only scanned once a matching device shows up, listing devices doesn't need it
+    existing_paths = None
 
-    if list_only:
-        for device in found_devices:
+    # Devices are consumed as they are parsed, no need to keep a list of them
+    for device in _enumerate_usb():
+        if list_only:
             print("Found device %s:%s at %s Manufacturer=%s, Product=%s" % device)
+        if device.vendor_id is None:
+            # Incomplete device record without P: line
+            continue
+        if vendor_id == device.vendor_id and product_id == device.product_id:
+            if existing_paths is None:
+                existing_paths = _get_existing_usb_device_nodes()
+            if device.device_path in existing_paths:
+                device_paths.append(device.device_path)
+            else:
+                print("Device path {} not existing".format(device.device_path))
     return device_paths
 
 
@@ -255,30 +389,69 @@ def send_signal_usb_device(device_path, signal):
     finddev(idVendor=0x0665, idProduct=0x5161).reset()
     """
 
-    if signal == "reset":
-        sig = USBDEVFS_RESET
-    elif signal == "disconnect":
-        sig = USBDEVFS_DISCONNECT
-    elif signal == "connect":
-        sig = USBDEVFS_CONNECT
-    else:
+    return _send_signals(device_path, [signal])
+
+
+def _send_signals(device_path, signals):
+    # type: (str, List[str]) -> bool
+    """
+    Send multiple signals to a usb device in given order, using a single file descriptor
+    See send_signal_usb_device for arguments
+    """
+
+    try:
+        sigs = [(signal, _SIGNALS[signal]) for signal in signals]
+    except KeyError:
         raise TypeError("Bad USB signal given")
+    if not sigs:
+        return True
 
-    print("Sending signal {} to usb device {}".format(signal, device_path))
+    signal = signals[0]
+    # Keep fd defined so a failing os.open doesn't end up in an UnboundLocalError below
+    fd = -1
+    success = True
     try:
         # Would be easier if os.open would have an __enter__ function for using with context
         fd = os.open(device_path, os.O_WRONLY)
-        fcntl.ioctl(fd, sig, 0)
-        success = True
-    except OSError:
-        print("Cannot {} USB device at {}".format(signal, device_path))
+        for signal, sig in sigs:
+            print("Sending signal {} to usb device {}".format(signal, device_path))
+            # A failing signal must not prevent the next ones from being sent
+            try:
+                ioctl(fd, sig)
+            except OSError as exc:
+                print(
+                    "Cannot {} USB device at {}: {}".format(
+                        signal, device_path, _os_error_reason(exc)
+                    )
+                )
+                success = False
+    except OSError as exc:
+        print(
+            "Cannot {} USB device at {}: {}".format(
+                signal, device_path, _os_error_reason(exc)
+            )
+        )
         success = False
     finally:
-        os.close(fd)
+        if fd >= 0:
+            os.close(fd)
     return success
 
 
+def _os_error_reason(exc):
+    # type: (OSError) -> str
+    """
+    Human readable reason of an OSError raised while talking to a usb device
+    """
+    if exc.errno in (errno.EACCES, errno.EPERM):
+        return "permission denied, please run this script as root"
+    return os.strerror(exc.errno) if exc.errno else str(exc)
+
+
 def interface():
+    # argparse is only needed by the CLI, don't pay its import cost when used as a library
+    import argparse
+
     description = (
         "USB hub / controllers & devices reset tool v{}\n"
         "{}\n"
@@ -372,10 +545,12 @@ def interface():
         help="Enable hub given by --hub switch, or hubs on which device given by --device is connected",
     )
 
-    args = parser.parse_args(args=None if sys.argv[1:] else ["--help"])
+    args = parser.parse_args(args=None if len(sys.argv) > 1 else ["--help"])
 
     vendor_id = None
     product_id = None
+    # Hub enumeration is reused between hub actions and --list-hubs
+    found_hubs = None
 
     if args.reset_all:
         reset_usb_controllers()
@@ -397,35 +572,50 @@ def interface():
     ):
         if args.reset_device or args.disconnect_device or args.connect_device:
             paths = get_usb_devices_paths(vendor_id, product_id)
-            for path in paths:
-                if args.reset_device:
-                    send_signal_usb_device(path, "reset")
-                if args.connect_device:
-                    send_signal_usb_device(path, "connect")
-                if args.disconnect_device:
-                    send_signal_usb_device(path, "disconnect")
+            # All requested signals are sent over a single open of each device
+            signals = [
+                signal
+                for signal, requested in (
+                    ("disconnect", args.disconnect_device),
+                    ("reset", args.reset_device),
+                    ("connect", args.connect_device),
+                )
+                if requested
+            ]
+
+            # ioctls block until the kernel is done with the device, so handle devices concurrently
+            with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+                list(executor.map(lambda path: _send_signals(path, signals), paths))
         else:
             if args.hub:
                 hubs = [args.hub]
             else:
-                hubs = get_usb_hubs(vendor_id, product_id)
-            if args.disable_hub:
-                for hub in hubs:
-                    hub_binder(hub, "unbind")
-            if args.enable_hub:
-                for hub in hubs:
-                    hub_binder(hub, "bind")
-            if args.reset_hub:
-                reset_usb_hubs(hubs)
+                found_hubs = get_usb_hubs(vendor_id, product_id)
+                hubs = found_hubs
+            hub_actions = []
+            for actions, requested in (
+                (("unbind",), args.disable_hub),
+                (("bind",), args.enable_hub),
+                (("unbind", "bind"), args.reset_hub),
+            ):
+                if requested:
+                    hub_actions.extend(actions)
+            for hub in hubs:
+                hub_binder(hub, *hub_actions)
 
     if args.list:
         get_usb_devices_paths(list_only=True)
 
     if args.list_hubs:
-        list_usb_hubs(vendor_id, product_id)
+        list_usb_hubs(vendor_id, product_id, found_hubs)
 
 
 def main():
+    # Only checked when running the CLI, so importing this module never exits the interpreter
+    if not "linux" in sys.platform:
+        print("This script can only run on Linux")
+        sys.exit(3)
+
     try:
         interface()
     except KeyboardInterrupt: